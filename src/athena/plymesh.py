@@ -15,29 +15,109 @@ from numpy.lib.recfunctions import repack_fields
 from athena import geom
 from earcut import earcut
 
-def tri_norm(a,b,c):
-    tri_normal = np.cross( a-b, a-c)
-    tri_normal /= np.linalg.norm(tri_normal)
-    return tri_normal
-
-def edge( a, b ):
-    return (min(a,b), max(a,b))
-
-def edgeIter(poly):
-    it = iter(poly)
-    i0 = next(it)
-    i_last = i0
-    for i in it:
-        yield edge( i_last, i )
-        i_last = i
-    yield edge( i_last, i0 )
-
-def sharedEdges(poly, vtx):
-    for a, b in edgeIter(poly):
-        if vtx == a:
-            yield b
-        elif vtx == b:
-            yield a
+# The compiled mapbox_earcut port is much faster than the bundled pure-Python
+# earcut, so use it when it's installed
+try:
+    import mapbox_earcut
+except ImportError:
+    mapbox_earcut = None
+
+def edgeKeys(poly):
+    '''
+    Pack each boundary edge of poly into a single integer, (max << 32) | min,
+    so that edges can be compared and counted without building index tuples.
+    A 2D array is treated as a stack of polygons with one polygon per row.
+    '''
+    a = np.asarray(poly, dtype=np.int64)
+    b = np.roll(a, -1, axis=-1)
+    return (np.maximum(a, b) << 32) | np.minimum(a, b)
+
+def triangulateEach(polys_xy):
+    '''
+    Triangulate each simple polygon in polys_xy, an (F, N, 2) stack of 2D
+    polygon coordinates.  Yields one flat int64 array of vertex positions per
+    polygon, three per triangle.  Inputs to the triangulator are prepared once
+    for the whole stack rather than once per polygon.
+    '''
+    if mapbox_earcut is not None:
+        rings = np.array( [polys_xy.shape[1]], dtype=np.uint32 )
+        for xy_coords in np.ascontiguousarray(polys_xy, dtype=np.float64):
+            yield np.asarray( mapbox_earcut.triangulate_float64(xy_coords, rings), dtype=np.int64 )
+    else:
+        # earcut wants flat lists of 2D coordinates; numpy can produce them
+        # for every polygon in one call, without walking nested lists as
+        # earcut.flatten does
+        for flat_coords in polys_xy.reshape(len(polys_xy), 2*polys_xy.shape[1]).tolist():
+            yield np.asarray( earcut.earcut(flat_coords, None, 2), dtype=np.int64 )
+
+def matchWinding(polys_xy, local_tris):
+    '''
+    Flip the triangles of any polygon whose triangulation winds against the
+    polygon's own vertex order.  polys_xy is an (F, k, 2) array of projected
+    polygon coordinates and local_tris an (F, T, 3) array of triangles given
+    as positions within each polygon.  Both windings are measured in 2D, by
+    comparing the sign of the polygon's shoelace area with that of the summed
+    signed areas of its triangles; this stays reliable for reflex or
+    collinear leading vertices, and for degenerate sliver triangles.
+    '''
+    faces = np.arange(len(polys_xy))[:, None, None]
+    tri_xy = polys_xy[faces, local_tris]
+    u = tri_xy[:,:,1] - tri_xy[:,:,0]
+    v = tri_xy[:,:,2] - tri_xy[:,:,0]
+    tris_area = ( u[:,:,0]*v[:,:,1] - u[:,:,1]*v[:,:,0] ).sum(axis=1)
+    next_xy = np.roll(polys_xy, -1, axis=1)
+    poly_area = ( polys_xy[:,:,0]*next_xy[:,:,1] - next_xy[:,:,0]*polys_xy[:,:,1] ).sum(axis=1)
+    flip = tris_area * poly_area < 0
+    local_tris[flip] = local_tris[flip][:, :, [0,2,1]]
+    return local_tris
+
+# Cache of fan triangulations, keyed by number of polygon sides
+_fan_tris = {}
+
+def fanTriangles(num_sides):
+    '''
+    Triangles fanning out from the first vertex of a convex polygon with
+    num_sides vertices, as a read-only (num_sides-2, 3) array of positions
+    within the polygon.  Meshes tend to repeat a handful of polygon sizes,
+    so each fan is only built once.
+    '''
+    fan = _fan_tris.get(num_sides)
+    if fan is None:
+        fan = np.empty( (num_sides-2, 3), dtype=np.int64 )
+        fan[:,0] = 0
+        fan[:,1] = np.arange(1, num_sides-1)
+        fan[:,2] = np.arange(2, num_sides)
+        fan.flags.writeable = False
+        _fan_tris[num_sides] = fan
+    return fan
+
+def emitFaceTriangles(polys_geom, local_tris, vertex_buf, tri_buf, vtx_idx, tri_idx):
+    '''
+    Write the triangles of a stack of polygons into preallocated buffers.
+
+    polys_geom is an (F, k, 3) array of polygon vertex positions, and local_tris
+    an (F, T, 3) array of triangles given as positions within each polygon.
+    vertex_buf is a (3, N, 3) array holding separate planes of vertex positions,
+    wing1 positions and wing2 positions.  Every triangle corner becomes a new
+    vertex whose position is its own and whose wings are its two neighbors
+    along the polygon boundary, and tri_buf receives the indices of those
+    vertices.
+    Writing starts at rows vtx_idx and tri_idx; the updated pair is returned.
+    '''
+    num_faces, num_sides, _ = polys_geom.shape
+    num_corners = 3 * local_tris.shape[1]
+    corners = local_tris.reshape(num_faces, num_corners)
+    num_vertices = corners.size
+    num_tris = num_vertices // 3
+    faces = np.arange(num_faces)[:, None]
+
+    rows = vertex_buf[:, vtx_idx:vtx_idx+num_vertices].reshape(3, num_faces, num_corners, 3)
+    rows[0] = polys_geom[faces, corners]
+    rows[1] = polys_geom[faces, corners - 1]
+    rows[2] = polys_geom[faces, (corners + 1) % num_sides]
+    tri_buf[tri_idx:tri_idx+num_tris] = np.arange(vtx_idx, vtx_idx+num_vertices).reshape(-1, 3)
+
+    return vtx_idx + num_vertices, tri_idx + num_tris
 
 class PlyMesh(Qt3DCore.QEntity):
     '''
@@ -51,106 +131,145 @@ class PlyMesh(Qt3DCore.QEntity):
         ply_faces = plydata['face'].data['vertex_indices']
 
         # The ply reader library returns the vertex data in numpy structured arrays,
-        # which wind up being annoying to access manually, so define a convenience
-        # lookup function here.
-        # FIXME A lot of probably-unnecessary copying of numpy data takes place here,
-        # causing loader slowness on very large ply models.
-        def vertex(indices):
-            vertices = np.take(ply_vertices, indices, axis=0)
-            fields = ['x', 'y', 'z'] # Ignore any othe per-vertex values
-            return np.r_[ [v[fields].item() for v in vertices] ]
+        # which wind up being annoying to access manually, so copy the coordinates
+        # into a packed Nx3 array once.  Indexing it with an array of vertex indices
+        # of any shape then gathers only the 24 bytes of xyz per vertex.
+        fields = ['x', 'y', 'z'] # Ignore any othe per-vertex values
+        positions = np.stack( [ply_vertices[f] for f in fields], axis=-1 ).astype(np.float64)
 
         flat_xy = np.all( 0 == ply_vertices['z'] )
         self.dimensions = 2 if flat_xy else 3
 
-        vertices = list()
-        triangles = list()
+        # Measure the faces in a single pass; everything below works from these
+        # sizes.  Triangles can be copied into the buffers in bulk, while larger
+        # polygons need to be triangulated.  plyfile stores each face as its own
+        # index array, so join them all into one flat array up front; the faces
+        # of any one size can then be gathered from it as a 2D array in one go.
+        face_sizes = np.fromiter( (poly.size for poly in ply_faces), dtype=np.int32, count=len(ply_faces) )
+        assert( np.all( face_sizes >= 3 ) )
+        large_sizes = face_sizes[face_sizes > 3]
+        flat_faces = np.concatenate( ply_faces ).astype(np.int64)
+        face_starts = np.cumsum(face_sizes) - face_sizes
+
+        def faces_of_size(num_sides):
+            starts = face_starts[face_sizes == num_sides]
+            return flat_faces[ starts[:, np.newaxis] + np.arange(num_sides) ]
+
+        # A k-sided polygon triangulates into k-2 triangles, and every triangle
+        # gets three vertices of its own, so the buffers can be sized up front.
+        total_tris = int( np.sum(face_sizes - 2) )
+        total_vertices = 3 * total_tris
+
+        # Indices address vertices, so 16 bits suffice whenever every vertex
+        # index fits in an unsigned short
+        vertex_basetype = geom.basetypes.Float
+        if( total_vertices <= 65536 ):
+            index_basetype = geom.basetypes.UnsignedShort
+        else:
+            index_basetype = geom.basetypes.UnsignedInt
 
-        def add_vtx(v, a, b):
-            vertices.append( np.hstack( [v , a , b] ) )
-            return len(vertices) - 1
+        # Every row that is handed to Qt gets written by emitFaceTriangles,
+        # so there is no need to zero-fill the buffers first
+        vertex_nparr = np.empty( [3, total_vertices, 3], dtype=geom.basetype_numpy_codes[vertex_basetype] )
+        tri_nparr = np.empty( [total_tris, 3], dtype=geom.basetype_numpy_codes[index_basetype] )
+        vtx_idx = 0
+        tri_idx = 0
 
         # Each vertex in the mesh has nine coordinates:
         # The xyz coordinates of the vertex itself, and
         # the xyz coordinates of the two points adjacent to that
         # vertex in the wireframe mesh.  (The vertex shader refers to these
-        # as wing1Vtx and wing2Vtx).  For a triangular face, a vertex's
-        # two wing vertices are simply the other two vertices of the triangle.
-        # add_simple_tri covers this case
-
-        def add_simple_tri( *args ):
-            A, B, C = vertex( args )
-            i = add_vtx(A, B, C)
-            j = add_vtx(B, A, C)
-            k = add_vtx(C, A, B)
-            triangles.append( (i, j, k) )
-
-        # For non-triangular faces, we generate triangles (in the loop below),
-        # and store each vertex with its adjacent edge vertices as its wing value.
+        # as wing1Vtx and wing2Vtx).  These are stored as three separate
+        # planes of vertex_nparr, one per vertex attribute.  emitFaceTriangles
+        # takes each triangle as positions within its polygon, so the wings
+        # are simply the polygon vertices on either side.  For a triangular
+        # face, these are the other two vertices of the triangle, so all of
+        # the triangular faces are written here in one go.
+
+        simple_tris = faces_of_size(3)[:, np.newaxis, :]
+        vtx_idx, tri_idx = emitFaceTriangles( positions[simple_tris.reshape(-1, 3)],
+                                              np.broadcast_to( np.arange(3), simple_tris.shape ),
+                                              vertex_nparr, tri_nparr, vtx_idx, tri_idx )
+
+        # For non-triangular faces, we generate triangles (in the loop below).
         # This assumes that all triangle vertices fall on the boundary of a polygon
         # face, which seems to be a valid assumption for triangulations produced
         # by the earcut library.
 
-        def add_complex_tri( a, b, c, poly ):
-            def add_vertex_with_edges( x ):
-                e1, e2 = tuple( x for x in sharedEdges(poly, x) )
-                return add_vtx( *vertex( (x, e1, e2) ) )
-            i = add_vertex_with_edges( a )
-            j = add_vertex_with_edges( b )
-            k = add_vertex_with_edges( c )
-            triangles.append( (i, j, k) )
-
-        for poly in ply_faces:
-            if len(poly) == 3:
-                add_simple_tri( *poly )
-            else:
-                external_edges = set( edgeIter( poly ) )
-                assert( len(external_edges) == len(poly) )
-                poly_geom = vertex(poly)
-                # Compute the normal of this polygon from the first three verts;
-                # we'll need this later to determine winding direction for the
-                # triangulated faces
-                poly_normal = tri_norm( *(poly_geom[x,:] for x in range(3)) )
-                # Geometric centroid of the polygon
-                G = np.average( poly_geom, axis=0 )
-                offset_geom = poly_geom - G
-                # Singular value decomposition: we want to map the 3D coordinates
-                # to a 2D subspace that can be fed into a 2D triangulation algorithm.
-                # For this we only need the last return value.
-                _, _, vh = np.linalg.svd(offset_geom)
-                vt = vh[:2,:].T
-                xy_coords = np.dot(offset_geom, vt)
-                flattened = earcut.flatten([xy_coords,[]])
-                new_tris = earcut.earcut(flattened['vertices'],None,flattened['dimensions'])
-
-                # Now we have the new triangles from earcut.
-                # Check the first one's normal; if it doesn't match the polygon normal,
-                # then we'll assume the 2D projection reversed our triangle windings.
-                geom_tri0 = poly_geom.take(new_tris[0:3], axis=0)
-                tri0_norm = tri_norm(*(geom_tri0[x,:] for x in range(3)))
-                normcheck = np.dot(tri0_norm, poly_normal)
-                flip = False
-                if( not np.isclose(normcheck, 1.0, rtol=1e-1) ):
-                    flip = True
-
-                # Now add new triangles to the buffers
-                for a,b,c in geom.grouper(new_tris,3):
-                    idx_a = poly[a]
-                    idx_b = poly[b]
-                    idx_c = poly[c]
-                    if( flip ): 
-                        idx_b, idx_c = idx_c, idx_b
-                    add_complex_tri( idx_a, idx_b, idx_c, poly )
+        # Group the large faces by number of sides, so that the per-polygon
+        # geometry can be computed with one batched numpy operation per group.
+        # Only earcut itself needs to visit polygons one at a time.
+        for num_sides in np.unique(large_sizes):
+            polys = faces_of_size(num_sides)
+            # Every boundary edge must be distinct, so that each vertex has
+            # exactly two neighbors to use as its wings
+            sorted_keys = np.sort( edgeKeys(polys), axis=1 )
+            assert( np.all( sorted_keys[:,1:] != sorted_keys[:,:-1] ) )
+            polys_geom = positions[polys]
+            # Geometric centroids of the polygons
+            G = polys_geom.mean( axis=1, keepdims=True )
+            offset_geom = polys_geom - G
+            # We want to map the 3D coordinates to a 2D subspace that can be fed
+            # into a 2D triangulation algorithm.  That plane is spanned by the two
+            # dominant right singular vectors of offset_geom, which are the
+            # eigenvectors of its 3x3 covariance matrix with the largest
+            # eigenvalues; eigh returns them in ascending order.
+            _, eigvecs = np.linalg.eigh( np.einsum('fij,fik->fjk', offset_geom, offset_geom) )
+            vt = eigvecs[:, :, [2,1]]
+            polys_xy = np.einsum('fij,fjk->fik', offset_geom, vt)
 
-        vertex_basetype = geom.basetypes.Float
-        if( len(triangles) < 30000 ):
-            index_basetype = geom.basetypes.UnsignedShort
-        else:
-            index_basetype = geom.basetypes.UnsignedInt
+            # Convex polygons don't need earcut at all: they can be fanned out
+            # from their first vertex.  A polygon is convex when every turn along
+            # its boundary bends the same way and the turns add up to a single
+            # revolution (which rules out self-intersecting stars).  Straight-angle
+            # vertices, such as an edge midpoint, leave float rounding noise in
+            # their turn, so turns are only compared against a tolerance scaled
+            # by the lengths of the two edges meeting there.
+            edge_vecs = np.roll(polys_xy, -1, axis=1) - polys_xy
+            next_vecs = np.roll(edge_vecs, -1, axis=1)
+            turns = edge_vecs[:,:,0]*next_vecs[:,:,1] - edge_vecs[:,:,1]*next_vecs[:,:,0]
+            dots = np.einsum('fij,fij->fi', edge_vecs, next_vecs)
+            turn_tol = 1e-5 * np.linalg.norm(edge_vecs, axis=2) * np.linalg.norm(next_vecs, axis=2)
+            total_turn = np.arctan2(turns, dots).sum(axis=1)
+            convex = ( np.all(turns >= -turn_tol, axis=1) | np.all(turns <= turn_tol, axis=1) ) \
+                     & np.isclose( np.abs(total_turn), 2*np.pi )
+            fan_tris = fanTriangles(num_sides)
+
+            # The fan follows the polygon's own vertex order, so its
+            # winding already matches the polygon's
+            convex_geom = polys_geom[convex]
+            vtx_idx, tri_idx = emitFaceTriangles( convex_geom,
+                                                  np.broadcast_to( fan_tris, (len(convex_geom),) + fan_tris.shape ),
+                                                  vertex_nparr, tri_nparr, vtx_idx, tri_idx )
+
+            # Everything else goes through earcut.  A simple polygon normally
+            # triangulates into exactly num_sides-2 triangles, so those results
+            # are stacked and emitted together; degenerate polygons for which
+            # earcut returns fewer triangles are emitted one at a time.
+            earcut_geom = polys_geom[~convex]
+            earcut_xy = polys_xy[~convex]
+            earcut_tris = np.empty( (len(earcut_geom), num_sides-2, 3), dtype=np.int64 )
+            complete = np.zeros( len(earcut_geom), dtype=bool )
+            for f, new_tris in enumerate( triangulateEach(earcut_xy) ):
+                new_tris = new_tris.reshape(-1, 3)
+                if( len(new_tris) == num_sides-2 ):
+                    earcut_tris[f] = new_tris
+                    complete[f] = True
+                elif( len(new_tris) > 0 ):
+                    # earcut's output winding depends on the orientation of the
+                    # 2D projection, so match it to the polygon's vertex order
+                    new_tris = matchWinding( earcut_xy[f:f+1], new_tris[np.newaxis] )
+                    vtx_idx, tri_idx = emitFaceTriangles( earcut_geom[f:f+1], new_tris,
+                                                          vertex_nparr, tri_nparr, vtx_idx, tri_idx )
 
-        vertex_nparr = np.array(vertices, dtype = geom.basetype_numpy_codes[vertex_basetype])
+            earcut_tris = matchWinding( earcut_xy[complete], earcut_tris[complete] )
+            vtx_idx, tri_idx = emitFaceTriangles( earcut_geom[complete], earcut_tris,
+                                                  vertex_nparr, tri_nparr, vtx_idx, tri_idx )
 
-        index_nparr = np.array( triangles, dtype=geom.basetype_numpy_codes[index_basetype])
+        # earcut may emit fewer than k-2 triangles for a degenerate polygon,
+        # so only hand the filled portion of the buffers to Qt
+        vertex_nparr = vertex_nparr[:, :vtx_idx]
+        index_nparr = tri_nparr[:tri_idx]
 
         self.geometry = Qt3DRender.QGeometry(self)
 
@@ -159,10 +278,10 @@ class PlyMesh(Qt3DCore.QEntity):
         wing1_attrname = 'wing1Vtx'
         wing2_attrname = 'wing2Vtx'
 
-        attrspecs = [ geom.AttrSpec(position_attrname, column=0, numcols=3 ),
-                      geom.AttrSpec(wing1_attrname, column=3, numcols=3),
-                      geom.AttrSpec(wing2_attrname, column=6, numcols=3) ]
-        self.posAttr, self.wing1Attr, self.wing2Attr = geom.buildVertexAttrs( parent, vertex_nparr, attrspecs )
+        # Each attribute gets its own tightly packed buffer
+        self.posAttr, self.wing1Attr, self.wing2Attr = \
+            ( geom.buildVertexAttrs( parent, plane, [geom.AttrSpec(name, column=0, numcols=3)] )[0]
+              for plane, name in zip(vertex_nparr, [position_attrname, wing1_attrname, wing2_attrname]) )
         self.geometry.addAttribute(self.posAttr)
         self.geometry.addAttribute(self.wing1Attr)
         self.geometry.addAttribute(self.wing2Attr)